@@ -3,12 +3,14 @@
 from Bio import Phylo
 import numpy as np
 import matplotlib as plt
+# Figures only ever go to files, so skip GUI backend setup
+plt.use('Agg')
 import pylab
 
 def drawMark(tree, label_func=str, do_show=True, show_confidence=True, 
              axes=None, branch_labels=None, label_colors=None, mark=[],
              markColor='r', markWeight='bold', lineColor='black',
-             *args, **kwargs):
+             outFormat=None, *args, **kwargs):
     try: 
         import matplotlib.pyplot as plt 
     except ImportError: 
@@ -20,15 +22,12 @@ def drawMark(tree, label_func=str, do_show=True, show_confidence=True,
  
     import matplotlib.collections as mpcollections 
  
-    # Arrays that store lines for the plot of clades 
-    horizontal_linecollections = [] 
-    vertical_linecollections = [] 
- 
     # Options for displaying branch labels / confidence 
     def conf2str(conf): 
         if int(conf) == conf: 
             return str(int(conf)) 
         return str(conf) 
+    show_branch_labels = True
     if not branch_labels: 
         if show_confidence: 
             def format_branch_label(clade): 
@@ -39,9 +38,12 @@ def drawMark(tree, label_func=str, do_show=True, show_confidence=True,
                 if clade.confidence is not None: 
                     return conf2str(clade.confidence) 
                 return None 
+            # Decided from the clades themselves once they are flattened 
+            show_branch_labels = None
         else: 
             def format_branch_label(clade): 
                 return None 
+            show_branch_labels = False
     elif isinstance(branch_labels, dict): 
         def format_branch_label(clade): 
             return branch_labels.get(clade) 
@@ -66,146 +68,196 @@ def drawMark(tree, label_func=str, do_show=True, show_confidence=True,
             return 'black' 
  
     # Layout 
+
+    # rcParams don't change during a render; look the line width up once 
+    default_lw = plt.rcParams['lines.linewidth']
+
+    def flatten_clades(root, color, lw): 
+        """Lay the clades out in drawing (pre-order) order. 
  
-    def get_x_positions(tree, cladogram=True): 
-        """Create a mapping of each clade to its horizontal position. 
+        Returns parallel arrays indexed by clade position: the clades, the 
+        index of each parent and of each last child (-1 if none), the line 
+        color and width, inherited from the parent unless overridden, and the 
+        depth of each clade by branch length and by number of branches. 
+        Depths are accumulated from the parent's on the way down. 
+        """ 
+        clades = []
+        parents = []
+        last_children = []
+        colors = []
+        lws = []
+        depths = []
+        levels = []
+        # Only a handful of distinct colors exist, each converted once 
+        hex_colors = {}
+        root_depth = root.branch_length or 0
+        stack = [(root, -1, color, lw, root_depth, root_depth)]
+        while stack:
+            clade, parent, color, lw, depth, level = stack.pop()
+            # phyloXML-only graphics annotations 
+            branch_color = getattr(clade, 'color', None)
+            if branch_color is not None: 
+                color = hex_colors.get(id(branch_color))
+                if color is None:
+                    color = hex_colors[id(branch_color)] = branch_color.to_hex() 
+            if getattr(clade, 'width', None) is not None: 
+                lw = clade.width * default_lw 
+            i = len(clades)
+            if parent >= 0:
+                # Children are visited in order, so the last one wins
+                last_children[parent] = i
+            clades.append(clade)
+            parents.append(parent)
+            last_children.append(-1)
+            colors.append(color)
+            lws.append(lw)
+            depths.append(depth)
+            levels.append(level)
+            stack.extend((child, i, color, lw, 
+                          depth + (child.branch_length or 0), level + 1) 
+                         for child in reversed(clade.clades)) 
+        return (clades, np.array(parents), np.array(last_children), 
+                np.array(colors), np.array(lws), 
+                np.array(depths, dtype=float), np.array(levels, dtype=float))
+
+    def get_x_positions(depths, levels, tips, cladogram=True): 
+        """Horizontal (radial) position of each flattened clade. 
  
-        Dict of {clade: x-coord} 
+        Array of x-coords, in flattened clade order 
         """ 
         global treeDepth
         if cladogram:
-            treeDepth = 0
-            for terminal in tree.get_terminals():
-                candidate = len(tree.get_path(terminal))
-                if candidate > treeDepth:
-                    treeDepth = candidate
-            depths = tree.depths(unit_branch_lengths=True)
-            for clade in depths.keys():
-                if clade.is_terminal():
-                    depths[clade] = treeDepth
+            depths = levels.copy()
+            # Levels start at the root's own branch length (depths[0]), but the 
+            # tips are pinned at the number of branches below the root 
+            treeDepth = depths.max() - depths[0]
+            depths[tips] = treeDepth
         else:
-            depths = tree.depths() 
             # If there are no branch lengths, assume unit branch lengths 
-            if not max(depths.values()): 
-                depths = tree.depths(unit_branch_lengths=True) 
+            if not depths.max(): 
+                depths = levels 
         return depths 
  
-    def get_y_positions(tree): 
+    def get_y_positions(last_children, tips): 
         global heights
-        """Create a mapping of each clade to its vertical position. 
+        """Vertical (angular) position of each flattened clade. 
  
-        Dict of {clade: y-coord}. 
-        Coordinates are negative, and integers for tips. 
+        Array of y-coords, in flattened clade order. 
         """ 
         maxheight = 2*np.pi
-        # Rows are defined by the tips 
-        heights = {tip: maxheight*(1 - (i/tree.count_terminals())) 
-                   for i, tip in enumerate(reversed(tree.get_terminals()))}
- 
-        # Internal nodes: place at midpoint of children 
-        def calc_row(clade): 
-            for subclade in clade: 
-                if subclade not in heights: 
-                    calc_row(subclade) 
-            # Closure over heights 
-            heights[clade] = (heights[clade.clades[0]] + 
-                              heights[clade.clades[-1]]) / 2.0 
+        heights = np.empty(len(last_children))
+        # Rows are defined by the tips, evenly spaced around the circle 
+        heights[tips] = np.linspace(maxheight, 0, len(tips), 
+                                    endpoint=False)[::-1]
+        heights = heights.tolist()
  
-        if tree.root.clades: 
-            calc_row(tree.root) 
+        # Internal nodes: place at midpoint of children. Children always come 
+        # after their parent in pre-order, so walking the clades backwards 
+        # settles both children before the parent 
+        last_children = last_children.tolist()
+        for i in range(len(heights) - 1, -1, -1):
+            last = last_children[i]
+            if last >= 0:
+                heights[i] = (heights[i + 1] + heights[last]) / 2.0 
+        heights = np.array(heights)
         return heights 
  
-    x_posns = get_x_positions(tree) 
-    y_posns = get_y_positions(tree) 
-    # The function draw_clade closes over the axes object 
+    (clades, parents, last_children, colors, lws, 
+     depths, levels) = flatten_clades(tree.root, 'k', default_lw) 
+    if show_branch_labels is None:
+        # Most trees carry no confidences at all; skip labelling them 
+        show_branch_labels = any( 
+            getattr(clade, 'confidences', None) or 
+            getattr(clade, 'confidence', None) is not None 
+            for clade in clades) 
+    tips = np.flatnonzero(last_children < 0)
+    xs = get_x_positions(depths, levels, tips) 
+    ys = get_y_positions(last_children, tips) 
+    # The function draw_branch_labels closes over the axes object 
     if axes is None: 
         fig = plt.figure() 
         axes = fig.add_subplot(111, projection='polar')
     elif not isinstance(axes, plt.matplotlib.axes.Axes): 
         raise ValueError("Invalid argument for axes: %s" % axes) 
  
-    def draw_clade_lines(use_linecollection=False, orientation='horizontal', 
-                         y_here=0, x_start=0, x_here=0, y_bot=0, y_top=0, 
-                         color=lineColor, lw='.1', resolution=100): 
-        """Create a line with or without a line collection object. 
- 
-        Graphical formatting of the lines representing clades in the plot can be 
-        customized by altering this function. 
-        """ 
-        if orientation == 'horizontal': 
-            if y_here == np.pi/2:
-                axes.plot([y_here+0.00018, y_here+0.00018], 
-                          [x_start+0.012, x_here+0.012], 
-                          color=color, lw=lw)
-            else:
-                axes.plot([y_here, y_here], 
-                          [x_start, x_here], 
-                          color=color, lw=lw)
-        elif orientation == 'vertical': 
-            axes.plot(np.linspace(y_bot, y_top, resolution), [x_here]*resolution, color=color, lw=lw)
+    # The root's branch starts at the origin 
+    x_starts = np.where(parents >= 0, xs[parents], 0) 
  
-    def draw_clade(clade, x_start, color, lw): 
-        """Recursively draw a tree, down from the given clade.""" 
-        x_here = x_posns[clade] 
-        y_here = y_posns[clade] 
-        # phyloXML-only graphics annotations 
-        if hasattr(clade, 'color') and clade.color is not None: 
-            color = clade.color.to_hex() 
-        if hasattr(clade, 'width') and clade.width is not None: 
-            lw = clade.width * plt.rcParams['lines.linewidth'] 
-        # Draw a horizontal line from start to here 
-        draw_clade_lines(use_linecollection=False, orientation='horizontal', 
-                         y_here=y_here, x_start=x_start, x_here=x_here, color=color, lw=lw) 
-        # Add node/taxon labels 
-        '''
-        label = label_func(clade) 
-        if label not in (None, clade.__class__.__name__): 
-            if label in mark:
-                axes.text(y_here, x_here, ' %s' % 
-                          label, verticalalignment='center', 
-                          color=markColor, fontweight=markWeight,
-                          rotation=y_here + np.pi/2) 
-            else:
-                axes.text(y_here, x_here, ' %s' % 
-                          label, verticalalignment='center', 
-                          color=get_label_color(label),
-                          rotation=y_here + np.pi/2) 
-        '''
-        # Add label above the branch (optional) 
-        conf_label = format_branch_label(clade) 
-        if conf_label:
-            axes.text(0.5 * (x_start + x_here), y_here, conf_label, 
-                      fontsize='small', horizontalalignment='center') 
-        if clade.clades: 
-            # Draw a vertical line connecting all children 
-            y_top = y_posns[clade.clades[0]] 
-            y_bot = y_posns[clade.clades[-1]] 
-            # Only apply widths to horizontal lines, like Archaeopteryx 
-            draw_clade_lines(use_linecollection=False, orientation='vertical', 
-                             x_here=x_here, y_bot=y_bot, y_top=y_top, 
-                             color=color, lw=lw) 
-            # Draw descendents 
-            for child in clade: 
-                draw_clade(child, x_here, color, lw) 
+    def draw_branch_labels(): 
+        """Place the branch labels, clade by clade, from the flattened arrays. 
  
-    draw_clade(tree.root, 0, 'k', plt.rcParams['lines.linewidth']) 
+        Clade lines are not drawn here; they are built in one go below. 
+        """ 
+        # Bind what the loop touches to locals, once, instead of going through 
+        # the closure and attribute lookups for every clade 
+        text = axes.text
+        branch_label = format_branch_label
+        for clade, x_start, x_here, y_here in zip( 
+                clades, x_starts.tolist(), xs.tolist(), ys.tolist()): 
+            # Add node/taxon labels 
+            '''
+            label = label_func(clade) 
+            if label not in (None, clade.__class__.__name__): 
+                if label in mark:
+                    axes.text(y_here, x_here, ' %s' % 
+                              label, verticalalignment='center', 
+                              color=markColor, fontweight=markWeight,
+                              rotation=y_here + np.pi/2) 
+                else:
+                    axes.text(y_here, x_here, ' %s' % 
+                              label, verticalalignment='center', 
+                              color=get_label_color(label),
+                              rotation=y_here + np.pi/2) 
+            '''
+            # Add label above the branch (optional) 
+            conf_label = branch_label(clade) 
+            if conf_label:
+                text(0.5 * (x_start + x_here), y_here, conf_label, 
+                     fontsize='small', horizontalalignment='center') 
  
-    # If line collections were used to create clade lines, here they are added 
-    # to the pyplot plot. 
-    for i in horizontal_linecollections: 
-        axes.add_collection(i) 
-    for i in vertical_linecollections: 
-        axes.add_collection(i) 
+    if show_branch_labels:
+        draw_branch_labels() 
+
+    # Clade lines are built straight from the flattened arrays and handed to
+    # matplotlib as one LineCollection per orientation. Horizontal lines run
+    # from the parent's depth to the clade's own; branches lying on the pi/2
+    # axis are nudged off it
+    n_clades = len(clades)
+    nudge = np.isclose(ys, np.pi/2)
+    h_segs = np.empty((n_clades, 2, 2))
+    h_segs[:, :, 0] = (ys + 0.00018*nudge)[:, None]
+    h_segs[:, 0, 1] = x_starts + 0.012*nudge
+    h_segs[:, 1, 1] = xs + 0.012*nudge
+    # A vertical arc joins the first and last child of every internal clade; 
+    # only apply widths to horizontal lines, like Archaeopteryx 
+    internal = np.flatnonzero(last_children >= 0)
+    v_ytop = ys[internal + 1]
+    v_ybot = ys[last_children[internal]]
+    # Arcs are sampled at a fixed resolution by scaling one shared template, 
+    # all of them in one go
+    resolution = 100
+    t = np.linspace(0, 1, resolution)
+    v_segs = np.empty((len(internal), resolution, 2))
+    v_segs[:, :, 0] = v_ybot[:, None] + t * (v_ytop - v_ybot)[:, None]
+    v_segs[:, :, 1] = xs[internal, None]
+    # Only raster formats are rasterized; vector output (svg, pdf, ps, eps) 
+    # keeps its branches as paths 
+    rasterized = outFormat in ('png', 'jpg', 'jpeg', 'tif', 'tiff')
+    axes.add_collection(mpcollections.LineCollection( 
+        h_segs, colors=colors, linewidths=lws, rasterized=rasterized)) 
+    axes.add_collection(mpcollections.LineCollection( 
+        v_segs, colors=colors[internal], linewidths=lws[internal], 
+        rasterized=rasterized)) 
  
     # Aesthetics 
     
-    #xmax = max(x_posns.values()) 
+    #xmax = xs.max() 
     #axes.set_xlim(-0.05 * xmax, 1.25 * xmax) 
     axes.set_rmax(treeDepth + 1)
     '''
-    ticks = np.linspace(0, 2*np.pi, 1 + len(tree.get_terminals()))
+    ticks = np.linspace(0, 2*np.pi, 1 + len(tips))
     axes.set_xticks(ticks)
-    axes.set_xticklabels(leaf.name for leaf in tree.get_terminals())
+    axes.set_xticklabels(clades[i].name for i in tips)
 
     angles = np.linspace(0,2*np.pi,len(axes.get_xticklabels())+1)
     #angles[np.cos(angles) < 0] = angles[np.cos(angles) < 0] + np.pi
@@ -243,6 +295,46 @@ def drawMark(tree, label_func=str, do_show=True, show_confidence=True,
     if do_show: 
         plt.show()
 
+def commonAncestor(tree, *targets):
+    """Most recent common ancestor (clade) of the given targets.
+
+    Paths from the root are cached on the tree, so later lookups on the same
+    tree only intersect them instead of searching the whole tree again.
+    """
+    if not hasattr(tree, '_path_cache'):
+        tree._path_cache = {}
+    paths = []
+    for target in targets:
+        try:
+            path = tree._path_cache.get(target)
+        except TypeError:
+            # Unhashable target specs (e.g. {'name': ...}) aren't cached
+            cacheable = False
+            path = None
+        else:
+            cacheable = True
+        if path is None:
+            path = tree.get_path(target)
+            if path is None:
+                raise ValueError("target %r is not in this tree" % target)
+            if cacheable:
+                tree._path_cache[target] = path
+        paths.append(path)
+    if not paths:
+        return tree.root
+    shared = set(paths[0]).intersection(*paths[1:])
+    # Paths run from the root down, so the last shared clade is the deepest
+    mrca = tree.root
+    for clade in paths[0]:
+        if clade in shared:
+            mrca = clade
+    return mrca
+
+# Parsed trees keyed by (treeName, ladderize), so that rendering the same tree
+# again (e.g. in another format) neither re-reads the file nor loses the root
+# paths commonAncestor cached on it
+_tree_cache = {}
+
 def drawTree(treeName,  
              outX,
              outY=10,
@@ -257,9 +349,14 @@ def drawTree(treeName,
     plt.rc('lines', lw=lineWidth, color='k')
     plt.rc('figure', figsize=(outX,10))
 
-    tree = Phylo.read(treeName + '.nwk', "newick")
-    if ladderize: tree.ladderize()
-    protein7 = tree.common_ancestor(toMark[0], toMark[1])
+    key = (treeName, ladderize)
+    if key in _tree_cache:
+        tree = _tree_cache[key]
+    else:
+        tree = Phylo.read(treeName + '.nwk', "newick")
+        if ladderize: tree.ladderize()
+        _tree_cache[key] = tree
+    protein7 = commonAncestor(tree, toMark[0], toMark[1])
     protein7.color = 'r'
 
     # for m in toMark:
@@ -267,13 +364,16 @@ def drawTree(treeName,
             # print('qwe')
             # tree.find_any(m).color = 'r'
 
-    drawMark(tree, lambda n: n.name, do_show=False, mark=[])
+    drawMark(tree, lambda n: n.name, do_show=False, mark=[], 
+             outFormat=outFormat)
     pylab.axis("off")
     pylab.savefig("{0}.{1}".format(treeName, outFormat),
                   format=outFormat,
                   #bbox_inches='tight',
                   #pad_inches=0,
                   dpi=outDPI)
+    # Free the figure so successive renders don't pile up in memory
+    pylab.close(pylab.gcf())
 
 toMark = ['XP_021076601.1_H(+)/Cl(-)_exchange_transporter_7_isoform_X3_Mus_pahari',
           'XP_012063553.1_PREDICTED:_H(+)/Cl(-)_exchange_transporter_7_Atta_cephalotes']
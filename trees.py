@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 
 from Bio import Phylo
+import numpy as np
 import matplotlib as plt
+# Figures only ever go to files, so skip GUI backend setup
+plt.use('Agg')
 import pylab
 
 def drawMark(tree, label_func=str, do_show=True, show_confidence=True, 
              axes=None, branch_labels=None, label_colors=None, mark=[],
-             markColor='r', markWeight='bold', *args, **kwargs):
+             markColor='r', markWeight='bold',
+             outFormat=None, *args, **kwargs):
     try: 
         import matplotlib.pyplot as plt 
     except ImportError: 
@@ -18,15 +22,12 @@ def drawMark(tree, label_func=str, do_show=True, show_confidence=True,
  
     import matplotlib.collections as mpcollections 
  
-    # Arrays that store lines for the plot of clades 
-    horizontal_linecollections = [] 
-    vertical_linecollections = [] 
- 
     # Options for displaying branch labels / confidence 
     def conf2str(conf): 
         if int(conf) == conf: 
             return str(int(conf)) 
         return str(conf) 
+    show_branch_labels = True
     if not branch_labels: 
         if show_confidence: 
             def format_branch_label(clade): 
@@ -37,9 +38,12 @@ def drawMark(tree, label_func=str, do_show=True, show_confidence=True,
                 if clade.confidence is not None: 
                     return conf2str(clade.confidence) 
                 return None 
+            # Decided from the clades themselves once they are flattened 
+            show_branch_labels = None
         else: 
             def format_branch_label(clade): 
                 return None 
+            show_branch_labels = False
     elif isinstance(branch_labels, dict): 
         def format_branch_label(clade): 
             return branch_labels.get(clade) 
@@ -64,117 +68,165 @@ def drawMark(tree, label_func=str, do_show=True, show_confidence=True,
             return 'black' 
  
     # Layout 
+
+    # rcParams don't change during a render; look the line width up once 
+    default_lw = plt.rcParams['lines.linewidth']
+
+    def flatten_clades(root, color, lw): 
+        """Lay the clades out in drawing (pre-order) order. 
  
-    def get_x_positions(tree): 
-        """Create a mapping of each clade to its horizontal position. 
+        Returns parallel arrays indexed by clade position: the clades, the 
+        index of each parent and of each last child (-1 if none), the line 
+        color and width, inherited from the parent unless overridden, and the 
+        depth of each clade by branch length and by number of branches. 
+        Depths are accumulated from the parent's on the way down. 
+        """ 
+        clades = []
+        parents = []
+        last_children = []
+        colors = []
+        lws = []
+        depths = []
+        levels = []
+        # Only a handful of distinct colors exist, each converted once 
+        hex_colors = {}
+        root_depth = root.branch_length or 0
+        stack = [(root, -1, color, lw, root_depth, root_depth)]
+        while stack:
+            clade, parent, color, lw, depth, level = stack.pop()
+            # phyloXML-only graphics annotations 
+            branch_color = getattr(clade, 'color', None)
+            if branch_color is not None: 
+                color = hex_colors.get(id(branch_color))
+                if color is None:
+                    color = hex_colors[id(branch_color)] = branch_color.to_hex() 
+            if getattr(clade, 'width', None) is not None: 
+                lw = clade.width * default_lw 
+            i = len(clades)
+            if parent >= 0:
+                # Children are visited in order, so the last one wins
+                last_children[parent] = i
+            clades.append(clade)
+            parents.append(parent)
+            last_children.append(-1)
+            colors.append(color)
+            lws.append(lw)
+            depths.append(depth)
+            levels.append(level)
+            stack.extend((child, i, color, lw, 
+                          depth + (child.branch_length or 0), level + 1) 
+                         for child in reversed(clade.clades)) 
+        return (clades, np.array(parents), np.array(last_children), 
+                np.array(colors), np.array(lws), 
+                np.array(depths, dtype=float), np.array(levels, dtype=float))
+
+    def get_x_positions(depths, levels): 
+        """Horizontal position of each flattened clade. 
  
-        Dict of {clade: x-coord} 
+        Array of x-coords, in flattened clade order 
         """ 
-        depths = tree.depths() 
         # If there are no branch lengths, assume unit branch lengths 
-        if not max(depths.values()): 
-            depths = tree.depths(unit_branch_lengths=True) 
+        if not depths.max(): 
+            depths = levels 
         return depths 
  
-    def get_y_positions(tree): 
-        """Create a mapping of each clade to its vertical position. 
+    def get_y_positions(last_children, tips): 
+        """Vertical position of each flattened clade. 
  
-        Dict of {clade: y-coord}. 
-        Coordinates are negative, and integers for tips. 
+        Array of y-coords, in flattened clade order. 
+        Coordinates are integers for tips. 
         """ 
-        maxheight = tree.count_terminals() 
+        heights = np.empty(len(last_children))
         # Rows are defined by the tips 
-        heights = {tip: maxheight - i 
-                   for i, tip in enumerate(reversed(tree.get_terminals()))} 
- 
-        # Internal nodes: place at midpoint of children 
-        def calc_row(clade): 
-            for subclade in clade: 
-                if subclade not in heights: 
-                    calc_row(subclade) 
-            # Closure over heights 
-            heights[clade] = (heights[clade.clades[0]] + 
-                              heights[clade.clades[-1]]) / 2.0 
- 
-        if tree.root.clades: 
-            calc_row(tree.root) 
-        return heights 
- 
-    x_posns = get_x_positions(tree) 
-    y_posns = get_y_positions(tree) 
-    # The function draw_clade closes over the axes object 
+        heights[tips] = np.arange(1, len(tips) + 1)
+        heights = heights.tolist()
+ 
+        # Internal nodes: place at midpoint of children. Children always come 
+        # after their parent in pre-order, so walking the clades backwards 
+        # settles both children before the parent 
+        last_children = last_children.tolist()
+        for i in range(len(heights) - 1, -1, -1):
+            last = last_children[i]
+            if last >= 0:
+                heights[i] = (heights[i + 1] + heights[last]) / 2.0 
+        return np.array(heights) 
+ 
+    (clades, parents, last_children, colors, lws, 
+     depths, levels) = flatten_clades(tree.root, 'k', default_lw) 
+    if show_branch_labels is None:
+        # Most trees carry no confidences at all; skip labelling them 
+        show_branch_labels = any( 
+            getattr(clade, 'confidences', None) or 
+            getattr(clade, 'confidence', None) is not None 
+            for clade in clades) 
+    xs = get_x_positions(depths, levels) 
+    ys = get_y_positions(last_children, np.flatnonzero(last_children < 0)) 
+    # The function draw_labels closes over the axes object 
     if axes is None: 
         fig = plt.figure() 
         axes = fig.add_subplot(1, 1, 1) 
     elif not isinstance(axes, plt.matplotlib.axes.Axes): 
         raise ValueError("Invalid argument for axes: %s" % axes) 
  
-    def draw_clade_lines(use_linecollection=False, orientation='horizontal', 
-                         y_here=0, x_start=0, x_here=0, y_bot=0, y_top=0, 
-                         color='black', lw='.1'): 
-        """Create a line with or without a line collection object. 
+    # The root's branch starts at the origin 
+    x_starts = np.where(parents >= 0, xs[parents], 0) 
+ 
+    def draw_labels(): 
+        """Place node and branch labels, clade by clade, from the flattened arrays. 
  
-        Graphical formatting of the lines representing clades in the plot can be 
-        customized by altering this function. 
+        Clade lines are not drawn here; they are built in one go below. 
         """ 
-        if not use_linecollection and orientation == 'horizontal': 
-            axes.hlines(y_here, x_start, x_here, color=color, lw=lw) 
-        elif use_linecollection and orientation == 'horizontal': 
-            horizontal_linecollections.append(mpcollections.LineCollection( 
-                [[(x_start, y_here), (x_here, y_here)]], color=color, lw=lw),) 
-        elif not use_linecollection and orientation == 'vertical': 
-            axes.vlines(x_here, y_bot, y_top, color=color) 
-        elif use_linecollection and orientation == 'vertical': 
-            vertical_linecollections.append(mpcollections.LineCollection( 
-                [[(x_here, y_bot), (x_here, y_top)]], color=color, lw=lw),) 
- 
-    def draw_clade(clade, x_start, color, lw): 
-        """Recursively draw a tree, down from the given clade.""" 
-        x_here = x_posns[clade] 
-        y_here = y_posns[clade] 
-        # phyloXML-only graphics annotations 
-        if hasattr(clade, 'color') and clade.color is not None: 
-            color = clade.color.to_hex() 
-        if hasattr(clade, 'width') and clade.width is not None: 
-            lw = clade.width * plt.rcParams['lines.linewidth'] 
-        # Draw a horizontal line from start to here 
-        draw_clade_lines(use_linecollection=True, orientation='horizontal', 
-                         y_here=y_here, x_start=x_start, x_here=x_here, color=color, lw=lw) 
-        # Add node/taxon labels 
-        label = label_func(clade) 
-        if label not in (None, clade.__class__.__name__): 
-            if label in mark:
-                axes.text(x_here, y_here, ' %s' % 
-                          label, verticalalignment='center', 
-                          color=markColor, fontweight=markWeight) 
-            else:
-                axes.text(x_here, y_here, ' %s' % 
-                          label, verticalalignment='center', 
-                          color=get_label_color(label)) 
-        # Add label above the branch (optional) 
-        conf_label = format_branch_label(clade) 
-        if conf_label:
-            axes.text(0.5 * (x_start + x_here), y_here, conf_label, 
-                      fontsize='small', horizontalalignment='center') 
-        if clade.clades: 
-            # Draw a vertical line connecting all children 
-            y_top = y_posns[clade.clades[0]] 
-            y_bot = y_posns[clade.clades[-1]] 
-            # Only apply widths to horizontal lines, like Archaeopteryx 
-            draw_clade_lines(use_linecollection=True, orientation='vertical', 
-                             x_here=x_here, y_bot=y_bot, y_top=y_top, color=color, lw=lw) 
-            # Draw descendents 
-            for child in clade: 
-                draw_clade(child, x_here, color, lw) 
- 
-    draw_clade(tree.root, 0, 'k', plt.rcParams['lines.linewidth']) 
- 
-    # If line collections were used to create clade lines, here they are added 
-    # to the pyplot plot. 
-    for i in horizontal_linecollections: 
-        axes.add_collection(i) 
-    for i in vertical_linecollections: 
-        axes.add_collection(i) 
+        # Bind what the loop touches to locals, once, instead of going through 
+        # the closure and attribute lookups for every clade 
+        text = axes.text
+        branch_label = format_branch_label
+        node_label = label_func
+        label_color = get_label_color
+        marked = set(mark)
+        show_conf = show_branch_labels
+        for clade, x_start, x_here, y_here in zip( 
+                clades, x_starts.tolist(), xs.tolist(), ys.tolist()): 
+            # Add node/taxon labels 
+            label = node_label(clade) 
+            if label not in (None, clade.__class__.__name__): 
+                if label in marked:
+                    text(x_here, y_here, ' %s' % 
+                         label, verticalalignment='center', 
+                         color=markColor, fontweight=markWeight) 
+                else:
+                    text(x_here, y_here, ' %s' % 
+                         label, verticalalignment='center', 
+                         color=label_color(label)) 
+            # Add label above the branch (optional) 
+            if show_conf:
+                conf_label = branch_label(clade) 
+                if conf_label:
+                    text(0.5 * (x_start + x_here), y_here, conf_label, 
+                         fontsize='small', horizontalalignment='center') 
+ 
+    draw_labels() 
+
+    # Clade lines are built straight from the flattened arrays and handed to
+    # matplotlib as one LineCollection per orientation. Horizontal lines run
+    # from the parent's depth to the clade's own
+    h_segs = np.empty((len(clades), 2, 2))
+    h_segs[:, 0, 0] = x_starts
+    h_segs[:, 1, 0] = xs
+    h_segs[:, :, 1] = ys[:, None]
+    # A vertical line joins the first and last child of every internal clade 
+    internal = np.flatnonzero(last_children >= 0)
+    v_segs = np.empty((len(internal), 2, 2))
+    v_segs[:, :, 0] = xs[internal, None]
+    v_segs[:, 0, 1] = ys[last_children[internal]]
+    v_segs[:, 1, 1] = ys[internal + 1]
+    # Only raster formats are rasterized; vector output (svg, pdf, ps, eps) 
+    # keeps its branches as paths 
+    rasterized = outFormat in ('png', 'jpg', 'jpeg', 'tif', 'tiff')
+    axes.add_collection(mpcollections.LineCollection( 
+        h_segs, colors=colors, linewidths=lws, rasterized=rasterized)) 
+    axes.add_collection(mpcollections.LineCollection( 
+        v_segs, colors=colors[internal], linewidths=lws[internal], 
+        rasterized=rasterized)) 
  
     # Aesthetics 
  
@@ -183,11 +235,11 @@ def drawMark(tree, label_func=str, do_show=True, show_confidence=True,
     axes.set_xlabel('branch length') 
     axes.set_ylabel('taxa') 
     # Add margins around the tree to prevent overlapping the axes 
-    xmax = max(x_posns.values()) 
+    xmax = xs.max() 
     axes.set_xlim(-0.05 * xmax, 1.25 * xmax) 
     # Also invert the y-axis (origin at the top) 
     # Add a small vertical margin, but avoid including 0 and N+1 on the y axis 
-    axes.set_ylim(max(y_posns.values()) + 0.8, 0.2) 
+    axes.set_ylim(ys.max() + 0.8, 0.2) 
  
     # Parse and process key word arguments as pyplot options 
     for key, value in kwargs.items(): 
@@ -209,6 +261,10 @@ def drawMark(tree, label_func=str, do_show=True, show_confidence=True,
     if do_show: 
         plt.show()
 
+# Parsed trees keyed by (treeName, ladderize), so that rendering the same tree
+# again (e.g. in another format) doesn't re-read the file
+_tree_cache = {}
+
 def drawTree(treeName,  
              outX,
              outY=10,
@@ -225,21 +281,29 @@ def drawTree(treeName,
     plt.rc('lines', lw=lineWidth, color='k')
     plt.rc('figure', figsize=(outX,10))
 
-    tree = Phylo.read(treeName + '.nwk', "newick")
-    if ladderize: tree.ladderize()
+    key = (treeName, ladderize)
+    if key in _tree_cache:
+        tree = _tree_cache[key]
+    else:
+        tree = Phylo.read(treeName + '.nwk', "newick")
+        if ladderize: tree.ladderize()
+        _tree_cache[key] = tree
 
     # for m in toMark:
         # if tree.find_any(m):
             # print('qwe')
             # tree.find_any(m).color = 'r'
 
-    drawMark(tree, lambda n: n.name, do_show=False, mark=mark)
+    drawMark(tree, lambda n: n.name, do_show=False, mark=mark, 
+             outFormat=outFormat)
     pylab.axis("off")
     pylab.savefig("{0}.{1}".format(treeName, outFormat),
                   format=outFormat,
                   bbox_inches='tight',
                   pad_inches=0,
                   dpi=outDPI)
+    # Free the figure so successive renders don't pile up in memory
+    pylab.close(pylab.gcf())
 
 toMark = ['NP_001278.1 Homo sapiens (human)',
           'NP_001278.1 H/Cl-exchange transporter 7']